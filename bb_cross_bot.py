@@ -1,25 +1,41 @@
 import os
-from datetime import datetime, timezone
+import functools
+import re
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
 import yfinance as yf
 import pandas as pd
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # ========= CONFIG =========
-TICKERS = [
+DEFAULT_TICKERS = [
     "AAPL", "MSFT", "TSLA", "SPY", "QQQ", "NVDA",
     "MES=F", "MNQ=F", "MGC=F", "MCL=F", "MHG=F", "SIL=F",
     "EURUSD=X", "GBPUSD=X", "JPY=X", "USDJPY=X", "USDCAD=X", "AUDUSD=X"
 ]
+# Comma-separated override, e.g. TICKERS="AAPL,MSFT,ES=F"
+TICKERS = [t.strip() for t in os.getenv("TICKERS", "").split(",") if t.strip()] or DEFAULT_TICKERS
 
-# Prefer a BB-specific webhook, otherwise reuse the RSI one
-WEBHOOK_URL = os.getenv("BB_DISCORD_WEBHOOK") or os.getenv("RSI_DISCORD_WEBHOOK")
+# DISCORD_WEBHOOK (README/workflow), else a BB-specific webhook, else reuse the RSI one
+WEBHOOK_URL = (os.getenv("DISCORD_WEBHOOK") or os.getenv("BB_DISCORD_WEBHOOK")
+               or os.getenv("RSI_DISCORD_WEBHOOK"))
+DISCORD_MAX_CHARS = 2000              # Discord's per-message content limit
 
-LOG_FILE = "bb_alert_log.txt"         # de-dup store (bar-timestamp keyed)
+DB_PATH = ".state/bb_alerts.sqlite"   # de-dup store (bar-timestamp keyed); .state is cached in CI
+ALERT_WINDOW_DAYS = 2                 # de-dup keys older than this are not loaded
 INTERVAL = "5m"
+BAR_DELTA = pd.Timedelta(minutes=5)   # span of one INTERVAL bar
 LOOKBACK_PERIOD = "7d"                # enough 5m bars for BB len=107
-BB_LEN = 107
-BB_MULT = 1.7
+BB_LEN = int(os.getenv("BB_LENGTH", "107"))
+BB_MULT = float(os.getenv("BB_MULT", "1.7"))
+BB_TAIL = 2                           # bands needed for the cross check (prev + last)
+FETCH_BATCH = 20                      # Yahoo serves at most ~20 symbols per request
+FETCH_WORKERS = 8                     # concurrent batch downloads
 
 # Map some common symbols to their TradingView exchange
 TRADINGVIEW_EXCHANGES = {
@@ -29,85 +45,194 @@ TRADINGVIEW_EXCHANGES = {
     "MHG=F": "COMEX", "SIL=F": "COMEX"
 }
 
+# Reused keep-alive session for Discord posts. Only rate limits (429, honouring Retry-After)
+# are retried: after a read timeout or 5xx the message may already be posted.
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4, pool_maxsize=8,
+    max_retries=Retry(total=3, read=0, backoff_factor=0.5, status_forcelist=[429],
+                      allowed_methods=None),
+))
+
 # ========= HELPERS =========
-def get_tradingview_link(ticker: str) -> str:
+# Yahoo suffix -> TradingView symbol builder (takes the bare root, e.g. "EURUSD", "MES", "AAPL")
+_SUFFIX_RE = re.compile(r"^(.+?)(?:=([XF]))?$")
+_TV_SYMBOL = {
     # FX (Yahoo: EURUSD=X) -> TradingView: FX:EURUSD
-    if ticker.endswith("=X"):
-        return f"https://www.tradingview.com/chart/?symbol=FX:{ticker.replace('=X','')}"
+    "X": lambda root: f"FX:{root}",
     # Futures (Yahoo: MES=F) -> TradingView continuous: MES1! (or exchange-mapped)
-    if ticker.endswith("=F"):
-        exch = TRADINGVIEW_EXCHANGES.get(ticker, "CME_MINI")
-        tv_ticker = ticker.replace("=F", "1!")
-        return f"https://www.tradingview.com/chart/?symbol={exch}:{tv_ticker}"
+    "F": lambda root: f"{TRADINGVIEW_EXCHANGES.get(root + '=F', 'CME_MINI')}:{root}1!",
     # Stocks/ETFs
-    exch = TRADINGVIEW_EXCHANGES.get(ticker, "NASDAQ")
-    return f"https://www.tradingview.com/chart/?symbol={exch}:{ticker}"
-
-def load_alerted_log(path: str = LOG_FILE) -> set:
-    try:
-        with open(path, "r") as f:
-            return set(line.strip() for line in f if line.strip())
-    except FileNotFoundError:
-        return set()
-
-def append_alert_log(keys: list, path: str = LOG_FILE):
-    with open(path, "a") as f:
-        for k in keys:
-            f.write(k + "\n")
-
-def send_discord_alert(items: list, bar_time_iso: str):
+    None: lambda root: f"{TRADINGVIEW_EXCHANGES.get(root, 'NASDAQ')}:{root}",
+}
+
+@functools.lru_cache(maxsize=64)
+def get_tradingview_link(ticker: str) -> str:
+    root, suffix = _SUFFIX_RE.match(ticker).groups()
+    return f"https://www.tradingview.com/chart/?symbol={_TV_SYMBOL[suffix](root)}"
+
+def db_init(path: str = DB_PATH) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS alerts ("
+        " symbol TEXT NOT NULL, signal TEXT NOT NULL, bar_ts TEXT NOT NULL,"
+        " PRIMARY KEY (symbol, signal, bar_ts))"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS bb_state ("
+        " symbol TEXT PRIMARY KEY, last_ts TEXT NOT NULL)"
+    )
+    return conn
+
+def load_alerted(conn: sqlite3.Connection, window_days: int = ALERT_WINDOW_DAYS) -> set:
+    # Only keys for recent bars can match this run; one query, then in-memory lookups
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=window_days)).strftime("%Y-%m-%d")
+    cur = conn.execute("SELECT symbol, signal, bar_ts FROM alerts WHERE bar_ts >= ?", (cutoff,))
+    return set(cur.fetchall())
+
+def mark_alerted(conn: sqlite3.Connection, keys: list):
+    # Caller commits: all of a run's writes go in one transaction
+    conn.executemany("INSERT OR IGNORE INTO alerts (symbol, signal, bar_ts) VALUES (?, ?, ?)", keys)
+
+def load_bb_state(conn: sqlite3.Connection) -> dict:
+    """{ticker: bar time of the last closed bar already evaluated}"""
+    return dict(conn.execute("SELECT symbol, last_ts FROM bb_state").fetchall())
+
+def save_bb_state(conn: sqlite3.Connection, state: dict):
+    # Caller commits, together with mark_alerted
+    conn.executemany("INSERT OR REPLACE INTO bb_state (symbol, last_ts) VALUES (?, ?)", state.items())
+
+def send_discord_alert(items: list, bar_time_iso: str) -> int:
+    """
+    Post the combined alert. Returns how many leading `items` Discord accepted (2xx);
+    messages go out in order, so a failure stops the run there.
+    """
     if not WEBHOOK_URL:
         print("❌ Discord webhook not configured.")
-        return
+        return 0
     lines = []
     for t, sig in items:
         label = "CROSS ABOVE UPPER" if sig == "UP" else "CROSS BELOW LOWER"
         lines.append(f"• **{t}** — {label} → [Chart]({get_tradingview_link(t)})")
-    msg = (
-        f"🎯 **Bollinger Cross** on **{INTERVAL}** | len={BB_LEN}, mult={BB_MULT}\n"
-        + "\n".join(lines)
-        + (f"\n🕒 Bar time: `{bar_time_iso}`" if bar_time_iso else "")
-    )
-    try:
-        r = requests.post(WEBHOOK_URL, json={"content": msg})
-        print(f"✅ Discord alert sent (status {r.status_code}).")
-    except Exception as e:
-        print(f"❌ Discord send error: {e}")
-
-def compute_bbands(close: pd.Series, length: int, mult: float):
-    basis = close.rolling(length, min_periods=length).mean()
-    stdev = close.rolling(length, min_periods=length).std(ddof=0)   # Wilder/Pine-like stdev
-    upper = basis + mult * stdev
-    lower = basis - mult * stdev
+    header = f"🎯 **Bollinger Cross** on **{INTERVAL}** | len={BB_LEN}, mult={BB_MULT}\n"
+    footer = f"\n🕒 Bar time: `{bar_time_iso}`" if bar_time_iso else ""
+
+    # Normally one message; split only if the lines would exceed Discord's content limit
+    budget = DISCORD_MAX_CHARS - len(header) - len(footer)
+    chunks, cur = [], []
+    for line in lines:
+        if cur and len("\n".join(cur + [line])) > budget:
+            chunks.append(cur)
+            cur = []
+        cur.append(line)
+    chunks.append(cur)
+
+    sent = 0
+    for chunk in chunks:
+        msg = header + "\n".join(chunk) + footer
+        try:
+            r = _SESSION.post(WEBHOOK_URL, json={"content": msg}, timeout=20)
+        except Exception as e:
+            print(f"❌ Discord send error: {e}")
+            return sent
+        if not r.ok:
+            print(f"❌ Discord rejected alert (status {r.status_code}): {r.text[:200]}")
+            return sent
+        sent += len(chunk)
+    print(f"✅ Discord alert sent (status {r.status_code}, {len(chunks)} message(s)).")
+    return sent
+
+def compute_bbands(close: np.ndarray, length: int, mult: float, tail: int = 2):
+    """
+    Bands for the last `tail` bars (NaN elsewhere), computed in one pass over
+    a strided window view: no intermediate Series, population stdev (Pine-like).
+    """
+    n = close.shape[0]
+    basis, upper, lower = np.full(n, np.nan), np.full(n, np.nan), np.full(n, np.nan)
+    start = max(n - tail, length - 1)
+    if start < n:
+        win = sliding_window_view(close[start - length + 1:], length)
+        m = win.mean(axis=1)
+        sd = win.std(axis=1)
+        basis[start:] = m
+        upper[start:] = m + mult * sd
+        lower[start:] = m - mult * sd
     return basis, upper, lower
 
-def check_bb_cross_5m(ticker: str):
+def bb_cross_masks(close: np.ndarray, upper: np.ndarray, lower: np.ndarray):
+    """Vectorized cross flags per bar: (above, below); bar 0 is never a cross."""
+    above = np.zeros(close.shape, dtype=bool)
+    below = np.zeros(close.shape, dtype=bool)
+    above[1:] = (close[:-1] <= upper[:-1]) & (close[1:] > upper[1:])
+    below[1:] = (close[:-1] >= lower[:-1]) & (close[1:] < lower[1:])
+    return above, below
+
+def fetch_5m(tickers: list) -> dict:
+    """Download 5m OHLC history for a batch of tickers in one request -> {ticker: DataFrame}."""
+    # Deliberately uncached: yfinance refuses requests_cache sessions, and each 5m run needs the new bar
+    big = yf.download(tickers, period=LOOKBACK_PERIOD, interval=INTERVAL, group_by="ticker",
+                      threads=True, progress=False, auto_adjust=False)
+    frames = {}
+    for t in tickers:
+        if isinstance(big.columns, pd.MultiIndex):
+            # yfinance upper-cases symbols in the column index
+            col = t.upper()
+            if col not in big.columns.get_level_values(0):
+                frames[t] = pd.DataFrame()
+                continue
+            df = big[col]
+        else:
+            df = big
+        frames[t] = df.dropna(how="all")
+    return frames
+
+def closed_bars(df: pd.DataFrame) -> pd.DataFrame:
+    """Drop the still-forming bar Yahoo returns last during market hours."""
+    if df.empty:
+        return df
+    last = df.index[-1]
+    if last.tzinfo is None:
+        last = last.tz_localize("UTC")
+    return df.iloc[:-1] if last + BAR_DELTA > pd.Timestamp.now(tz="UTC") else df
+
+@functools.lru_cache(maxsize=256)
+def fmt_bar(ts) -> str:
+    return ts.tz_convert("UTC").strftime("%Y-%m-%d %H:%M:%S %Z") if hasattr(ts, "tz_convert") else str(ts)
+
+def check_bb_cross_5m(df: pd.DataFrame):
     """
     Return (triggered(bool), signal('UP'|'DOWN'|None), prev_close, prev_upper, prev_lower,
             last_close, last_upper, last_lower, bar_time)
     Signal 'UP'  = close crossed ABOVE upper band on the last closed bar.
     Signal 'DOWN'= close crossed BELOW lower band on the last closed bar.
     """
-    df = yf.download(ticker, period=LOOKBACK_PERIOD, interval=INTERVAL, progress=False, auto_adjust=False)
     if df.empty or "Close" not in df.columns:
         return (False, None, None, None, None, None, None, None, None)
 
-    # compute bands
-    basis, upper, lower = compute_bbands(df["Close"], BB_LEN, BB_MULT)
-    df = df.assign(Basis=basis, Upper=upper, Lower=lower).dropna(subset=["Basis","Upper","Lower"])
+    # compute bands; keep only bars with fully-formed bands, as plain arrays
+    # Bands are only computed for the last BB_TAIL bars, so drop missing closes first
+    # (otherwise a NaN newest close would leave no fully-formed bar to compare)
+    df = df[df["Close"].notna()]
+    close = df["Close"].to_numpy(np.float64)
+    basis, upper, lower = compute_bbands(close, BB_LEN, BB_MULT, BB_TAIL)
+    valid = ~np.isnan(basis)
+    c, u, l = close[valid], upper[valid], lower[valid]
 
-    if len(df) < 2:
+    if c.shape[0] < 2:
         # Not enough fully-formed bars for a cross check
         return (False, None, None, None, None, None, None, None, None)
 
-    prev, last = df.iloc[-2], df.iloc[-1]
-    prev_close, last_close = float(prev["Close"]), float(last["Close"])
-    prev_upper, prev_lower = float(prev["Upper"]), float(prev["Lower"])
-    last_upper, last_lower = float(last["Upper"]), float(last["Lower"])
-    last_time = df.index[-1]
+    # float64 scalars already; formatting happens at the print site
+    prev_close, last_close = c[-2], c[-1]
+    prev_upper, prev_lower = u[-2], l[-2]
+    last_upper, last_lower = u[-1], l[-1]
+    last_time = df.index[valid][-1]
 
-    cross_above = (prev_close <= prev_upper) and (last_close > last_upper)
-    cross_below = (prev_close >= prev_lower) and (last_close < last_lower)
+    above, below = bb_cross_masks(c, u, l)
+    cross_above, cross_below = bool(above[-1]), bool(below[-1])
 
     if cross_above:
         return (True, "UP", prev_close, prev_upper, prev_lower, last_close, last_upper, last_lower, last_time)
@@ -118,37 +243,72 @@ def check_bb_cross_5m(ticker: str):
 # ========= MAIN =========
 if __name__ == "__main__":
     print(f"🔍 Run at {datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S %Z')} | interval={INTERVAL} | BB(len={BB_LEN}, mult={BB_MULT})")
-    already = load_alerted_log()
+    conn = db_init()
+    already = load_alerted(conn)
+    last_seen = load_bb_state(conn)
+    evaluated = {}         # ticker -> bar time evaluated this run
     to_alert = []          # list of (ticker, 'UP'|'DOWN')
     alert_keys = []
     bar_time_for_message = None
 
-    for t in TICKERS:
-        try:
-            (triggered, sig,
-             pC, pU, pL, cC, cU, cL, bar_time) = check_bb_cross_5m(t)
+    # Tickers already evaluated on the newest closed bar have nothing new to download
+    expected_bar = fmt_bar(pd.Timestamp.now(tz="UTC").floor(BAR_DELTA) - BAR_DELTA)
+    pending = [t for t in TICKERS if last_seen.get(t) != expected_bar]
+    if len(pending) < len(TICKERS):
+        print(f"… skipping {len(TICKERS) - len(pending)} ticker(s) already checked @ {expected_bar}")
 
-            if bar_time is None:
-                print(f"… {t}: no BB yet (insufficient data)")
+    # One request per batch of tickers; overlap batches, evaluate on the main thread
+    batches = [pending[i:i + FETCH_BATCH] for i in range(0, len(pending), FETCH_BATCH)]
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as ex:
+        futures = {ex.submit(fetch_5m, b): b for b in batches}
+        for fut in as_completed(futures):
+            try:
+                frames = fut.result()
+            except Exception as e:
+                print(f"❌ {','.join(futures[fut])}: download error {e}")
                 continue
+            for t, df in frames.items():
+                try:
+                    # A closed bar's bands never change: skip tickers with no new bar since last run
+                    df = closed_bars(df)
+                    if not df.empty and last_seen.get(t) == fmt_bar(df.index[-1]):
+                        print(f"… {t}: no new closed bar since {last_seen[t]}")
+                        continue
 
-            # Diagnostics
-            bar_iso = bar_time.tz_convert("UTC").strftime("%Y-%m-%d %H:%M:%S %Z") if hasattr(bar_time, "tz_convert") else str(bar_time)
-            if pC is not None:
-                print(f"… {t}: prevC={pC:.6f} prevU={pU:.6f} prevL={pL:.6f} | curC={cC:.6f} curU={cU:.6f} curL={cL:.6f} @ {bar_iso}")
-
-            if triggered:
-                # de-dup key uses ticker + the specific bar timestamp + signal
-                key = f"{t}|{sig}|{bar_iso}"
-                if key not in already:
-                    to_alert.append((t, sig))
-                    alert_keys.append(key)
-                    bar_time_for_message = bar_iso
-        except Exception as e:
-            print(f"❌ {t}: error {e}")
+                    (triggered, sig,
+                     pC, pU, pL, cC, cU, cL, bar_time) = check_bb_cross_5m(df)
 
+                    if bar_time is None:
+                        print(f"… {t}: no BB yet (insufficient data)")
+                        continue
+
+                    # Diagnostics
+                    bar_iso = fmt_bar(bar_time)
+                    evaluated[t] = bar_iso
+                    if pC is not None:
+                        print(f"… {t}: prevC={pC:.6f} prevU={pU:.6f} prevL={pL:.6f} | curC={cC:.6f} curU={cU:.6f} curL={cL:.6f} @ {bar_iso}")
+
+                    if triggered:
+                        # de-dup key uses ticker + the specific bar timestamp + signal
+                        key = (t, sig, bar_iso)
+                        if key not in already:
+                            to_alert.append((t, sig))
+                            alert_keys.append(key)
+                            bar_time_for_message = bar_iso
+                except Exception as e:
+                    print(f"❌ {t}: error {e}")
+
+    delivered = 0
     if to_alert:
-        send_discord_alert(to_alert, bar_time_for_message or "")
-        append_alert_log(alert_keys)
+        delivered = send_discord_alert(to_alert, bar_time_for_message or "")
+        # Forget undelivered bars so only those alerts are retried next run
+        for t, _ in to_alert[delivered:]:
+            evaluated.pop(t, None)
     else:
         print("📉 No BB crosses this run.")
+
+    # All of the run's state is written after the network work, in a single commit
+    with conn:
+        mark_alerted(conn, alert_keys[:delivered])
+        save_bb_state(conn, evaluated)
+    conn.close()   # checkpoints the WAL back into the db file before the state is cached